@@ -114,6 +114,13 @@ if "$priv_ok"; then
         echo "failed"
         exit 1
     fi
+    echo -n "Setting wpa_supplicant directory permissions..."
+    if sudo chown $1 /etc/wpa_supplicant > /dev/null 2>&1 ; then
+        echo "success"
+    else
+        echo "failed"
+        exit 1
+    fi
     echo -n "Creating program log file..."
     if sudo touch /var/log/wpable.log > /dev/null 2>&1 ; then
         echo "success"
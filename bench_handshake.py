@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: LGPL-2.1-or-later
+
+# Times the secure session handshake and a config payload round trip.
+# Run on the target board (e.g. Pi Zero W) and compare against the pairing
+# time reported by btmon for the same central.
+
+import json
+import sys
+import time
+
+from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey
+from cryptography.hazmat.primitives.serialization import Encoding, PublicFormat
+
+from server import SESSION_COUNTER_LEN, SessionKey, WLAN_CONFIGURE_CHRC_UUID
+
+ITERATIONS = 200
+
+def client_public_key():
+    client = X25519PrivateKey.generate()
+    return client.public_key().public_bytes(Encoding.Raw, PublicFormat.Raw)
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else ITERATIONS
+    aad = WLAN_CONFIGURE_CHRC_UUID.encode()
+    payload = json.dumps({'ssid': 'network', 'psk': 'passphrase'}).encode()
+
+    # Client keys are generated on the central, so leave them out of the timing
+    client_keys = [client_public_key() for _ in range(iterations)]
+
+    start = time.perf_counter()
+    for client_public in client_keys:
+        key = SessionKey(client_public)
+    elapsed = time.perf_counter() - start
+    print(f"handshake:  {elapsed / iterations * 1000.0:.3f} ms")
+
+    start = time.perf_counter()
+    for _ in range(iterations):
+        counter = key.write_counter.to_bytes(SESSION_COUNTER_LEN, 'big')
+        key.decrypt(key.encrypt(payload, aad + counter), aad)
+    elapsed = time.perf_counter() - start
+    print(f"round trip: {elapsed / iterations * 1000.0:.3f} ms")
+
+if __name__ == '__main__':
+    main()
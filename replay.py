@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: LGPL-2.1-or-later
+
+# Replays a GATT trace recorded with WPABLE_TRACE against a server running on
+# a private D-Bus daemon. This process stands in for BlueZ: it owns org.bluez
+# on that bus, makes the GATT calls and emits Device1 disconnect signals,
+# while the server writes to a scratch copy of wpa_supplicant.conf and
+# provisioning cache and never restarts dhcpcd or touches the WLAN interface,
+# so it runs unprivileged on any host with dbus-daemon.
+#
+#   $ WPABLE_TRACE=/tmp/wpable.trace python3 server.py   # on the device
+#   $ python3 replay.py /tmp/wpable.trace                  # original speed
+#   $ python3 replay.py --fast /tmp/wpable.trace           # back to back
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import dbus
+import dbus.bus
+import dbus.service
+
+REPLAY_BUS_NAME = 'org.wpable.Replay'
+SERVER_START_TIMEOUT = 30.0
+REPLAY_HWADDR = '02:00:00:00:00:01' # stands in for wlan0, which the host may lack
+
+DBUS_OM_IFACE = 'org.freedesktop.DBus.ObjectManager'
+DBUS_PROP_IFACE = 'org.freedesktop.DBus.Properties'
+BLUEZ_SERVICE_NAME = 'org.bluez'
+BLUEZ_DEVICE_IFACE = 'org.bluez.Device1'
+
+OP_IFACES = {
+    'GetManagedObjects': DBUS_OM_IFACE,
+    'GetAll': DBUS_PROP_IFACE,
+}
+
+
+# Stand-in for a BlueZ device object, only used to announce disconnects
+class FakeDevice(dbus.service.Object):
+    @dbus.service.signal(DBUS_PROP_IFACE, signature='sa{sv}as')
+    def PropertiesChanged(self, interface, changed, invalidated):
+        pass
+
+
+def serve(address, wpa_path):
+    import dbus.mainloop.glib
+    import server
+
+    server.WPA_SUPPLICANT_PATH = wpa_path
+    server.DHCPCD_RESTART_CMD = ['true']
+    server.PROVISION_CACHE_PATH = os.path.join(os.path.dirname(wpa_path), 'provisioned.json')
+    server.WLAN_HWADDR = REPLAY_HWADDR
+    server.WLAN_SSID_CMD = ['true']
+
+    dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+    bus = dbus.bus.BusConnection(address)
+    server.create_application(bus)
+    bus.request_name(REPLAY_BUS_NAME)
+    server.mainloop.run()
+
+
+def load(trace_path):
+    entries = []
+    with open(trace_path, 'r') as trace:
+        for line in trace:
+            line = line.strip()
+            if line:
+                entries.append(json.loads(line))
+    entries.sort(key=lambda entry: entry['t'])
+    return entries
+
+
+def chrc_iface(path):
+    return 'org.bluez.GattDescriptor1' if '/desc' in path else 'org.bluez.GattCharacteristic1'
+
+
+def call(bus, devices, entry):
+    op = entry['op']
+    if op == 'Disconnect':
+        device = entry['device']
+        if device not in devices:
+            devices[device] = FakeDevice(bus, device)
+        devices[device].PropertiesChanged(BLUEZ_DEVICE_IFACE, {'Connected': dbus.Boolean(False)}, [])
+        return
+    obj = bus.get_object(REPLAY_BUS_NAME, entry['path'], introspect=False)
+    method = obj.get_dbus_method(op, OP_IFACES.get(op, chrc_iface(entry['path'])))
+    options = dict(entry.get('options', {}))
+    if 'device' in entry:
+        options['device'] = dbus.ObjectPath(entry['device'])
+    if op == 'GetManagedObjects':
+        method()
+    elif op == 'GetAll':
+        method(entry['iface'])
+    elif op == 'ReadValue':
+        method(dbus.Dictionary(options, signature='sv'))
+    elif op == 'WriteValue':
+        if 'payload' in entry:
+            value = bytearray(entry['payload'], 'utf-8')
+        else:
+            value = bytearray(entry['in'])
+        method(dbus.Array(value, signature='y'), dbus.Dictionary(options, signature='sv'))
+    else:
+        method()
+
+
+def replay(bus, entries, fast):
+    results = {}
+    devices = {}
+    start = time.monotonic()
+    origin = entries[0]['t'] if entries else 0.0
+    for entry in entries:
+        if not fast:
+            delay = (entry['t'] - origin) - (time.monotonic() - start)
+            if delay > 0:
+                time.sleep(delay)
+        key = (entry['op'], entry.get('path', ''))
+        result = results.setdefault(key, {'latency': [], 'errors': 0})
+        began = time.monotonic()
+        try:
+            call(bus, devices, entry)
+        except dbus.exceptions.DBusException:
+            result['errors'] += 1
+        result['latency'].append(time.monotonic() - began)
+    return results
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def summarize(results):
+    summary = []
+    for (op, path), result in sorted(results.items()):
+        latency = result['latency']
+        summary.append({
+            'op': op,
+            'path': path,
+            'count': len(latency),
+            'errors': result['errors'],
+            'mean_ms': 1000.0 * sum(latency) / len(latency),
+            'p50_ms': 1000.0 * percentile(latency, 0.50),
+            'p95_ms': 1000.0 * percentile(latency, 0.95),
+            'max_ms': 1000.0 * max(latency),
+        })
+    return summary
+
+
+def report(summary):
+    print(f"{'op':<18} {'path':<40} {'count':>6} {'err':>4} {'mean':>8} {'p50':>8} {'p95':>8} {'max':>8}")
+    for row in summary:
+        print(f"{row['op']:<18} {row['path']:<40} {row['count']:>6} {row['errors']:>4} "
+              f"{row['mean_ms']:>8.3f} {row['p50_ms']:>8.3f} {row['p95_ms']:>8.3f} {row['max_ms']:>8.3f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay a wpable GATT trace and report latency (ms) per operation')
+    parser.add_argument('trace', help='trace file written by the server when WPABLE_TRACE is set')
+    parser.add_argument('--fast', action='store_true', help='issue calls back to back instead of at original speed')
+    parser.add_argument('--json', action='store_true', help='print results as JSON for comparing versions')
+    parser.add_argument('--serve', nargs=2, metavar=('ADDRESS', 'WPA_PATH'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(*args.serve)
+        return
+
+    entries = load(args.trace)
+    workdir = tempfile.mkdtemp(prefix='wpable-replay-')
+    wpa_path = os.path.join(workdir, 'wpa_supplicant.conf')
+    shutil.copy(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'wpa_supplicant.conf'), wpa_path)
+
+    daemon = subprocess.Popen(
+        ['dbus-daemon', '--session', '--nofork', '--print-address'],
+        stdout=subprocess.PIPE, universal_newlines=True)
+    server = None
+    try:
+        address = daemon.stdout.readline().strip()
+        bus = dbus.bus.BusConnection(address)
+        # The server only trusts disconnect signals sent by BlueZ
+        bus.request_name(BLUEZ_SERVICE_NAME)
+        server = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--serve', address, wpa_path, args.trace])
+        deadline = time.monotonic() + SERVER_START_TIMEOUT
+        while not bus.name_has_owner(REPLAY_BUS_NAME):
+            if server.poll() is not None or time.monotonic() > deadline:
+                sys.exit('Replay server failed to start')
+            time.sleep(0.1)
+
+        summary = summarize(replay(bus, entries, args.fast))
+        if args.json:
+            print(json.dumps(summary, indent=2))
+        else:
+            report(summary)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+        daemon.terminate()
+        daemon.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
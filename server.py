@@ -24,40 +24,56 @@ import dbus
 import dbus.exceptions
 import dbus.mainloop.glib
 import dbus.service
-import array
+import functools
+import hashlib
 import json
 import logging
+import os
 import subprocess
 import time
 
+from cryptography.exceptions import InvalidSignature, InvalidTag
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey, X25519PublicKey
+from cryptography.hazmat.primitives.ciphers.aead import ChaCha20Poly1305
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from cryptography.hazmat.primitives.serialization import Encoding, PublicFormat, load_pem_public_key
 from scapy.all import get_if_hwaddr
 from gi.repository import GLib, GObject
 
 mainloop = GLib.MainLoop()
 
 logger = logging.getLogger(__name__)
-formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
 
-logHandler = logging.StreamHandler()
-filelogHandler = logging.FileHandler("/var/log/wpable.log")
+LOG_PATH = "/var/log/wpable.log"
 
-logHandler.setFormatter(formatter)
-filelogHandler.setFormatter(formatter)
+# Called from main() so importing this module (e.g. from replay.py) does not
+# need write access to /var/log
+def setup_logging():
+    formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
 
-logger.addHandler(logHandler)
-logger.addHandler(filelogHandler)
+    logHandler = logging.StreamHandler()
+    filelogHandler = logging.FileHandler(LOG_PATH)
 
-logger.setLevel(logging.INFO)
+    logHandler.setFormatter(formatter)
+    filelogHandler.setFormatter(formatter)
+
+    logger.addHandler(logHandler)
+    logger.addHandler(filelogHandler)
+
+    logger.setLevel(logging.INFO)
 
 AGENT_PATH = "/org/bluez/wpable/agent"
 
 DEFAULT_WLAN_IFACE = "wlan0"
+WLAN_HWADDR = None # overrides the MAC address read from DEFAULT_WLAN_IFACE
 WLAN_IFACE_BT_NAME = "rpi-vctrl"
 
 DBUS_OM_IFACE                 = 'org.freedesktop.DBus.ObjectManager'
 DBUS_PROP_IFACE               = 'org.freedesktop.DBus.Properties'
 
 BLUEZ_SERVICE_NAME            = 'org.bluez'
+BLUEZ_DEVICE_IFACE            = 'org.bluez.Device1'
 
 AGENT_IFACE                   = "org.bluez.Agent1"
 
@@ -85,68 +101,155 @@ class InvalidValueLengthException(dbus.exceptions.DBusException):
 class FailedException(dbus.exceptions.DBusException):
     _dbus_error_name = 'org.bluez.Error.Failed'
 
+class InvalidOffsetException(dbus.exceptions.DBusException):
+    _dbus_error_name = 'org.bluez.Error.InvalidOffset'
+
+
+class UnknownObjectException(dbus.exceptions.DBusException):
+    _dbus_error_name = 'org.freedesktop.DBus.Error.UnknownObject'
+
 
-class Application(dbus.service.Object):
+# Constant D-Bus arrays (flags, CUD values) are built once and shared by
+# every object that declares the same contents
+INTERNED_ARRAYS = {}
+
+def intern_array(values, signature):
+    key = (signature, tuple(values))
+    if key not in INTERNED_ARRAYS:
+        INTERNED_ARRAYS[key] = dbus.Array(values, signature=signature)
+    return INTERNED_ARRAYS[key]
+
+
+class DescriptorObjects(dbus.service.FallbackObject):
+    """
+    org.bluez.GattDescriptor1 dispatch for every descriptor in the application
+    """
+    @dbus.service.method(GATT_DESC_IFACE, in_signature='a{sv}', out_signature='ay', path_keyword='path')
+    def ReadValue(self, options, path=None):
+        return self.find(path, Descriptor).ReadValue(options)
+
+    @dbus.service.method(GATT_DESC_IFACE, in_signature='aya{sv}', path_keyword='path')
+    def WriteValue(self, value, options, path=None):
+        self.find(path, Descriptor).WriteValue(value, options)
+
+
+class Application(DescriptorObjects):
     """
     org.bluez.GattApplication1 interface implementation
+
+    Exported once as a fallback object so the services, characteristics and
+    descriptors beneath it are plain objects rather than D-Bus exports.
     """
     def __init__(self, bus):
         self.path = '/'
         self.services = []
-        dbus.service.Object.__init__(self, bus, self.path)
+        self.objects = {}
+        self.managed_objects = None
+        dbus.service.FallbackObject.__init__(self, bus, self.path)
+        bus.add_signal_receiver(
+            self.properties_changed,
+            dbus_interface=DBUS_PROP_IFACE,
+            signal_name='PropertiesChanged',
+            bus_name=BLUEZ_SERVICE_NAME,
+            arg0=BLUEZ_DEVICE_IFACE,
+            path_keyword='path',
+        )
+
+    # Lets services drop per-device state when a central goes away
+    def properties_changed(self, interface, changed, invalidated, path=None):
+        if interface != BLUEZ_DEVICE_IFACE:
+            return
+        if 'Connected' in changed and not changed['Connected']:
+            for service in self.services:
+                service.device_disconnected(path)
 
     def get_path(self):
         return dbus.ObjectPath(self.path)
 
     def add_service(self, service):
         self.services.append(service)
+        self.objects[service.path] = service
+        for chrc in service.get_characteristics():
+            self.objects[chrc.path] = chrc
+            for desc in chrc.get_descriptors():
+                self.objects[desc.path] = desc
+        self.managed_objects = None
+
+    def find(self, path, kind):
+        obj = self.objects.get(path)
+        if not isinstance(obj, kind):
+            raise UnknownObjectException(path)
+        return obj
 
     @dbus.service.method(DBUS_OM_IFACE, out_signature='a{oa{sa{sv}}}')
     def GetManagedObjects(self):
-        response = {}
         logger.info('GetManagedObjects')
-
-        for service in self.services:
-            response[service.get_path()] = service.get_properties()
-            chrcs = service.get_characteristics()
-            for chrc in chrcs:
-                response[chrc.get_path()] = chrc.get_properties()
-                descs = chrc.get_descriptors()
-                for desc in descs:
-                    response[desc.get_path()] = desc.get_properties()
-        return response
+        if self.managed_objects is None:
+            self.managed_objects = {}
+            for obj in self.objects.values():
+                self.managed_objects[obj.get_path()] = obj.get_properties()
+        return self.managed_objects
+
+    @dbus.service.method(DBUS_PROP_IFACE, in_signature='s', out_signature='a{sv}', path_keyword='path')
+    def GetAll(self, interface, path=None):
+        return self.find(path, (Service, Characteristic, Descriptor)).GetAll(interface)
+
+    @dbus.service.method(GATT_CHRC_IFACE, in_signature='a{sv}', out_signature='ay', path_keyword='path')
+    def ReadValue(self, options, path=None):
+        return self.find(path, Characteristic).ReadValue(options)
+
+    @dbus.service.method(GATT_CHRC_IFACE, in_signature='aya{sv}', path_keyword='path')
+    def WriteValue(self, value, options, path=None):
+        self.find(path, Characteristic).WriteValue(value, options)
+
+    @dbus.service.method(GATT_CHRC_IFACE, path_keyword='path')
+    def StartNotify(self, path=None):
+        self.find(path, Characteristic).StartNotify()
+
+    @dbus.service.method(GATT_CHRC_IFACE, path_keyword='path')
+    def StopNotify(self, path=None):
+        self.find(path, Characteristic).StopNotify()
+
+    @dbus.service.signal(DBUS_PROP_IFACE, signature='sa{sv}as', rel_path_keyword='rel_path')
+    def PropertiesChanged(self, interface, changed, invalidated, rel_path=None):
+        pass
 
 
-class Service(dbus.service.Object):
+class Service():
     """
     org.bluez.GattService1 interface implementation
     """
     PATH_BASE = '/org/bluez/wpable/service'
 
-    def __init__(self, bus, index, uuid, primary):
+    __slots__ = ('path', 'uuid', 'primary', 'characteristics', 'properties')
+
+    def __init__(self, index, uuid, primary):
         self.path = self.PATH_BASE + str(index)
-        self.bus = bus
         self.uuid = uuid
         self.primary = primary
         self.characteristics = []
-        dbus.service.Object.__init__(self, bus, self.path)
+        self.properties = None
 
     def get_properties(self):
-        return {
-                GATT_SERVICE_IFACE: {
-                        'UUID': self.uuid,
-                        'Primary': self.primary,
-                        'Characteristics': dbus.Array(
-                                self.get_characteristic_paths(),
-                                signature='o')
-                }
-        }
+        # Built once the characteristics are known and reused from then on
+        if self.properties is None:
+            self.properties = {
+                    GATT_SERVICE_IFACE: {
+                            'UUID': self.uuid,
+                            'Primary': self.primary,
+                            'Characteristics': dbus.Array(
+                                    self.get_characteristic_paths(),
+                                    signature='o')
+                    }
+            }
+        return self.properties
 
     def get_path(self):
         return dbus.ObjectPath(self.path)
 
     def add_characteristic(self, characteristic):
         self.characteristics.append(characteristic)
+        self.properties = None
 
     def get_characteristic_paths(self):
         result = []
@@ -157,43 +260,51 @@ class Service(dbus.service.Object):
     def get_characteristics(self):
         return self.characteristics
 
-    @dbus.service.method(DBUS_PROP_IFACE, in_signature='s', out_signature='a{sv}')
+    def device_disconnected(self, device):
+        pass
+
     def GetAll(self, interface):
         if interface != GATT_SERVICE_IFACE:
             raise InvalidArgsException()
         return self.get_properties()[GATT_SERVICE_IFACE]
 
 
-class Characteristic(dbus.service.Object):
+class Characteristic():
     """
     org.bluez.GattCharacteristic1 interface implementation
     """
-    def __init__(self, bus, index, uuid, flags, service):
+    __slots__ = ('path', 'uuid', 'service', 'flags', 'description', 'descriptors', 'properties')
+
+    def __init__(self, index, uuid, flags, service, description=None):
         self.path = service.path + '/char' + str(index)
-        self.bus = bus
         self.uuid = uuid
         self.service = service
-        self.flags = flags
+        self.flags = intern_array(flags, 's')
+        self.description = description
         self.descriptors = []
-        dbus.service.Object.__init__(self, bus, self.path)
+        self.properties = None
 
     def get_properties(self):
-        return {
-                GATT_CHRC_IFACE: {
-                        'Service': self.service.get_path(),
-                        'UUID': self.uuid,
-                        'Flags': self.flags,
-                        'Descriptors': dbus.Array(
-                                self.get_descriptor_paths(),
-                                signature='o')
-                }
-        }
+        # Built once the descriptors are known and reused from then on
+        if self.properties is None:
+            self.properties = {
+                    GATT_CHRC_IFACE: {
+                            'Service': self.service.get_path(),
+                            'UUID': self.uuid,
+                            'Flags': self.flags,
+                            'Descriptors': dbus.Array(
+                                    self.get_descriptor_paths(),
+                                    signature='o')
+                    }
+            }
+        return self.properties
 
     def get_path(self):
         return dbus.ObjectPath(self.path)
 
     def add_descriptor(self, descriptor):
         self.descriptors.append(descriptor)
+        self.properties = None
 
     def get_descriptor_paths(self):
         result = []
@@ -204,52 +315,41 @@ class Characteristic(dbus.service.Object):
     def get_descriptors(self):
         return self.descriptors
 
-    @dbus.service.method(DBUS_PROP_IFACE, in_signature='s', out_signature='a{sv}')
     def GetAll(self, interface):
         if interface != GATT_CHRC_IFACE:
             raise InvalidArgsException()
 
         return self.get_properties()[GATT_CHRC_IFACE]
 
-    @dbus.service.method(GATT_CHRC_IFACE, in_signature='a{sv}', out_signature='ay')
     def ReadValue(self, options):
         logger.error('Default ReadValue called, returning error')
         raise NotSupportedException()
 
-    @dbus.service.method(GATT_CHRC_IFACE, in_signature='aya{sv}')
     def WriteValue(self, value, options):
         logger.error('Default WriteValue called, returning error')
         raise NotSupportedException()
 
-    @dbus.service.method(GATT_CHRC_IFACE)
     def StartNotify(self):
         logger.error('Default StartNotify called, returning error')
         raise NotSupportedException()
 
-    @dbus.service.method(GATT_CHRC_IFACE)
     def StopNotify(self):
         logger.error('Default StopNotify called, returning error')
         raise NotSupportedException()
 
-    @dbus.service.signal(DBUS_PROP_IFACE, signature='sa{sv}as')
-    def PropertiesChanged(self, interface, changed, invalidated):
-        pass
-
 
-class Descriptor(dbus.service.Object):
+class Descriptor():
     """
     org.bluez.GattDescriptor1 interface implementation
     """
-    def __init__(self, bus, index, uuid, flags, characteristic):
+    __slots__ = ('path', 'uuid', 'flags', 'chrc', 'properties')
+
+    def __init__(self, index, uuid, flags, characteristic):
         self.path = characteristic.path + '/desc' + str(index)
-        self.bus = bus
         self.uuid = uuid
-        self.flags = flags
+        self.flags = intern_array(flags, 's')
         self.chrc = characteristic
-        dbus.service.Object.__init__(self, bus, self.path)
-
-    def get_properties(self):
-        return {
+        self.properties = {
                 GATT_DESC_IFACE: {
                         'Characteristic': self.chrc.get_path(),
                         'UUID': self.uuid,
@@ -257,21 +357,21 @@ class Descriptor(dbus.service.Object):
                 }
         }
 
+    def get_properties(self):
+        return self.properties
+
     def get_path(self):
         return dbus.ObjectPath(self.path)
 
-    @dbus.service.method(DBUS_PROP_IFACE, in_signature='s', out_signature='a{sv}')
     def GetAll(self, interface):
         if interface != GATT_DESC_IFACE:
             raise InvalidArgsException()
         return self.get_properties()[GATT_DESC_IFACE]
 
-    @dbus.service.method(GATT_DESC_IFACE, in_signature='a{sv}', out_signature='ay')
     def ReadValue(self, options):
         logger.error('Default ReadValue called, returning error')
         raise NotSupportedException()
 
-    @dbus.service.method(GATT_DESC_IFACE, in_signature='aya{sv}')
     def WriteValue(self, value, options):
         logger.error('Default WriteValue called, returning error')
         raise NotSupportedException()
@@ -363,6 +463,10 @@ class Advertisement(dbus.service.Object):
     def Release(self):
         logger.info('%s: Released!' % self.path)
 
+    @dbus.service.signal(DBUS_PROP_IFACE, signature='sa{sv}as')
+    def PropertiesChanged(self, interface, changed, invalidated):
+        pass
+
 
 class Agent(dbus.service.Object):
     exit_on_release = True
@@ -433,12 +537,13 @@ class CharacteristicUserDescriptionDescriptor(Descriptor):
     """
     CUD_UUID = '2901'
 
-    def __init__(self, bus, index, characteristic):
+    __slots__ = ('writable', 'value')
+
+    def __init__(self, index, characteristic):
         self.writable = 'writable-auxiliaries' in characteristic.flags
-        self.value = array.array('B', b'Registers characteristic user description (CUD) descriptors for the application')
-        self.value = self.value.tolist()
+        self.value = intern_array(characteristic.description.encode('utf-8'), 'y')
         Descriptor.__init__(
-                self, bus, index,
+                self, index,
                 self.CUD_UUID,
                 ['read', 'write'],
                 characteristic)
@@ -463,6 +568,7 @@ WPA_SSID_DEFAULT = ''
 WPA_SCAN_SSID_DEFAULT = 1
 WPA_PSK_DEFAULT = ''
 WPA_KEY_MGMT_DEFAULT = 'WPA-PSK'
+WPA_QUOTED_PARAMS = ('ssid', 'psk') # write() adds the quotes back
 
 def parse(file_path):
     myvars = {}
@@ -474,28 +580,70 @@ def parse(file_path):
 
 # Manages read/write from/to WPA_SUPPLICANT file
 class WpaSupplicant():
-    def __init__(self, file_path=WPA_SUPPLICANT_PATH):
-        self.file_path = file_path
+    def __init__(self, file_path=None):
+        self.file_path = file_path or WPA_SUPPLICANT_PATH
         self.params = self.defaults()
+        self.version = None # checksum of the file params were read from
+
+    def checksum(self):
+        with open(self.file_path, 'rb') as myfile:
+            return hashlib.sha256(myfile.read()).hexdigest()
 
     def read(self):
+        self.version = self.checksum()
         args = parse(self.file_path)
         for key, value in args.items():
             if key in self.params:
+                if key in WPA_QUOTED_PARAMS and len(value) >= 2 and value[0] == value[-1] == '"':
+                    value = value[1:-1]
                 self.params[key] = value
         return
 
+    # Writes a temporary file beside the target and renames it over the top,
+    # so losing power mid-write never leaves a truncated config behind.
+    # Returns the checksum of what was written.
     def write(self):
-        with open(self.file_path, 'w') as myfile:
-            myfile.write('ctrl_interface=DIR=/var/run/wpa_supplicant GROUP=netdev\n')
-            myfile.write('update_config=1\n')
-            myfile.write(f"country={self.params['country']}\n")
-            myfile.write('network={\n')
-            myfile.write(f"ssid=\"{self.params['ssid']}\"\n")
-            myfile.write(f"scan_ssid={self.params['scan_ssid']}\n")
-            myfile.write(f"psk=\"{self.params['psk']}\"\n")
-            myfile.write(f"key_mgmt={self.params['key_mgmt']}\n")
-            myfile.write('}')
+        data = ''.join([
+            'ctrl_interface=DIR=/var/run/wpa_supplicant GROUP=netdev\n',
+            'update_config=1\n',
+            f"country={self.params['country']}\n",
+            'network={\n',
+            f"ssid=\"{self.params['ssid']}\"\n",
+            f"scan_ssid={self.params['scan_ssid']}\n",
+            f"psk=\"{self.params['psk']}\"\n",
+            f"key_mgmt={self.params['key_mgmt']}\n",
+            '}',
+        ]).encode('utf-8')
+        try:
+            mode = os.stat(self.file_path).st_mode & 0o777
+        except FileNotFoundError:
+            mode = 0o600
+        directory = os.path.dirname(os.path.abspath(self.file_path))
+        temp_path = self.file_path + '.tmp'
+        fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+        try:
+            with os.fdopen(fd, 'wb') as myfile:
+                myfile.write(data)
+                myfile.flush()
+                os.fsync(myfile.fileno())
+            os.replace(temp_path, self.file_path)
+        except Exception:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        # Make the rename itself durable
+        dir_fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+        return hashlib.sha256(data).hexdigest()
+
+    # Optimistic commit: only write if the file is unchanged since it was read
+    def commit(self):
+        if self.version is not None and self.checksum() != self.version:
+            raise FailedException('WLAN configuration changed by another device')
+        self.version = self.write()
         return
 
     def defaults(self):
@@ -508,34 +656,330 @@ class WpaSupplicant():
         }
 
 
+DHCPCD_RESTART_CMD = ['systemctl', 'restart', 'dhcpcd']
+
 # Moderates restarting the dhcpcd service
 class DhcpMonitor():
     def __init__(self):
         self.__state = 'IDLE' # IDLE -> RESTART -> IDLE
         self.__process = None
         self.__start_time = None
+        self.__queued = False # restart requested while one was running
 
+    # Polls rather than waits so the main loop is never blocked
     def state(self):
-        try:
-            if self.__state == 'RESTART':
-                outs, errs = self.__process.communicate(timeout=1)
+        if self.__state == 'RESTART':
+            returncode = self.__process.poll()
+            if returncode is not None:
                 self.__state = 'IDLE'
                 self.__process = None
-                stdouts = '<ok>' if not outs else outs.strip()
-                stderrs = '<ok>' if not errs else errs.strip()
-                logger.info("dhcpcd restarted: " + stdouts + " / " + stderrs)
-        except subprocess.TimeoutExpired:
-            if time.time() > self.__start_time + 15.0: # subprocess timed out
+                logger.info("dhcpcd restarted: " + ('<ok>' if returncode == 0 else f"exit status {returncode}"))
+            elif time.time() > self.__start_time + 15.0: # subprocess timed out
                 self.__process.kill()
+                self.__process.wait()
                 self.__process = None
                 self.__state = 'IDLE'
+            if self.__state == 'IDLE' and self.__queued:
+                self.__queued = False
+                self.restart()
         return self.__state
 
+    # A restart requested while one is running is queued rather than dropped,
+    # since the running one may predate the latest config
     def restart(self):
         if self.__state == 'IDLE':
             self.__state = 'RESTART'
             self.__start_time = time.time()
-            self.__process = subprocess.Popen(['systemctl', 'restart', 'dhcpcd'])
+            self.__process = subprocess.Popen(DHCPCD_RESTART_CMD)
+        else:
+            self.__queued = True
+
+
+SESSION_KEY_TTL = 3600.0 # seconds a derived key survives reconnects
+SESSION_KEY_INFO = b'wpable session key'
+SESSION_PUBLIC_KEY_LEN = 32
+SESSION_NONCE_LEN = 12
+SESSION_COUNTER_LEN = 8
+SESSION_TAG_LEN = 16
+# Resume: server public key, then an encrypted empty write proving the key
+SESSION_RESUME_LEN = SESSION_PUBLIC_KEY_LEN + SESSION_NONCE_LEN + SESSION_TAG_LEN
+
+# Refuse plaintext config reads/writes from devices without a session key
+WLAN_REQUIRE_SECURE_SESSION = False
+
+def derive_session_key(private_key, peer_public, public):
+    shared = private_key.exchange(X25519PublicKey.from_public_bytes(peer_public))
+    return HKDF(
+        algorithm=hashes.SHA256(),
+        length=32,
+        salt=None,
+        info=SESSION_KEY_INFO + peer_public + public,
+    ).derive(shared)
+
+
+# AEAD key for one device, derived from an X25519 exchange with the central
+class SessionKey():
+    def __init__(self, peer_public):
+        private_key = X25519PrivateKey.generate()
+        self.public = private_key.public_key().public_bytes(Encoding.Raw, PublicFormat.Raw)
+        self.aead = ChaCha20Poly1305(derive_session_key(private_key, peer_public, self.public))
+        self.expires = time.time() + SESSION_KEY_TTL
+        self.write_counter = 0 # writes accepted under this key
+
+    def expired(self):
+        return time.time() > self.expires
+
+    # Ciphertext is prefixed with its random nonce
+    def encrypt(self, data, aad):
+        nonce = os.urandom(SESSION_NONCE_LEN)
+        return nonce + self.aead.encrypt(nonce, bytes(data), aad)
+
+    # Writes are authenticated with the next write counter appended to the
+    # AAD, so a captured write cannot be accepted a second time
+    def decrypt(self, data, aad):
+        data = bytes(data)
+        if len(data) <= SESSION_NONCE_LEN:
+            raise InvalidValueLengthException()
+        aad = aad + self.write_counter.to_bytes(SESSION_COUNTER_LEN, 'big')
+        try:
+            plaintext = self.aead.decrypt(data[:SESSION_NONCE_LEN], data[SESSION_NONCE_LEN:], aad)
+        except InvalidTag:
+            raise NotPermittedException('Payload failed authentication')
+        self.write_counter += 1
+        return plaintext
+
+
+# Fleet provisioning is enabled by installing the fleet's Ed25519 public key
+FLEET_PUBLIC_KEY_PATH = '/etc/wpable/fleet.pem'
+PROVISION_CACHE_PATH = '/etc/wpable/provisioned.json'
+GATT_MAX_ATTR_LEN = 512 # largest attribute value, long writes included
+PROVISION_HEADER_LEN = 2 # big-endian length of the (optionally encrypted) frame
+PROVISION_SIGNATURE_LEN = 64
+PROVISION_VERIFY_TIMEOUT = 60.0 # seconds to wait for the WLAN to associate
+WLAN_SSID_CMD = ['iwgetid', DEFAULT_WLAN_IFACE, '--raw']
+
+PROVISION_STATUS_UNPROVISIONED = 0x00
+PROVISION_STATUS_CONFIGURED = 0x01
+PROVISION_STATUS_VERIFIED = 0x02
+PROVISION_STATUS_FAILED = 0x03
+PROVISION_STATUS_NAMES = {
+    PROVISION_STATUS_UNPROVISIONED: 'unprovisioned',
+    PROVISION_STATUS_CONFIGURED: 'configured',
+    PROVISION_STATUS_VERIFIED: 'verified',
+    PROVISION_STATUS_FAILED: 'failed',
+}
+
+def wlan_hwaddr():
+    return WLAN_HWADDR or get_if_hwaddr(DEFAULT_WLAN_IFACE)
+
+def load_fleet_key(file_path):
+    try:
+        with open(file_path, 'rb') as myfile:
+            return load_pem_public_key(myfile.read())
+    except FileNotFoundError:
+        return None
+
+# Applies signed provisioning bundles and tracks the status that is
+# advertised. Verified bundles are remembered so a repeat is skipped.
+class FleetProvisioner():
+    def __init__(self, dhcpcd_monitor):
+        self.dhcpcd_monitor = dhcpcd_monitor
+        self.public_key = load_fleet_key(FLEET_PUBLIC_KEY_PATH)
+        self.device_id = list(bytes.fromhex(wlan_hwaddr().replace(':', ''))[-3:])
+        self.listeners = []
+        self.pending = None
+        self.timer = None
+        self.probing = False
+        self.cache = self.load()
+        # A remembered status only holds while the config it described is in place
+        self.status = PROVISION_STATUS_UNPROVISIONED
+        if self.cache['config'] == WpaSupplicant().checksum():
+            self.status = self.cache['status']
+
+    def load(self):
+        try:
+            with open(PROVISION_CACHE_PATH, 'r') as myfile:
+                return json.load(myfile)
+        except (FileNotFoundError, ValueError):
+            return {'status': PROVISION_STATUS_UNPROVISIONED, 'config': None, 'verified': {}}
+
+    def save(self):
+        try:
+            with open(PROVISION_CACHE_PATH, 'w') as myfile:
+                json.dump(self.cache, myfile)
+        except OSError as e:
+            logger.error(f"Provisioning cache not saved: {e}")
+
+    def set_status(self, status, config):
+        self.cache['status'] = status
+        self.cache['config'] = config
+        self.save()
+        if status != self.status:
+            self.status = status
+            logger.info("Provisioning status: " + PROVISION_STATUS_NAMES[status])
+            for listener in self.listeners:
+                listener(status)
+
+    def provision(self, frame):
+        if len(frame) <= PROVISION_SIGNATURE_LEN:
+            raise InvalidValueLengthException()
+        signature, body = frame[:PROVISION_SIGNATURE_LEN], frame[PROVISION_SIGNATURE_LEN:]
+        try:
+            self.public_key.verify(signature, body)
+        except InvalidSignature:
+            raise NotPermittedException('Bundle signature invalid')
+        bundle = json.loads(body.decode('utf-8'))
+        # A bundle may be limited to the devices on a pallet manifest
+        devices = bundle.get('devices')
+        if devices is not None and bytes(self.device_id).hex() not in devices:
+            raise NotPermittedException('Bundle not issued for this device')
+
+        digest = hashlib.sha256(frame).hexdigest()
+        wpa = WpaSupplicant()
+        wpa.read()
+        if self.cache['verified'].get(digest) == wpa.version:
+            logger.info("Provisioning bundle already verified, skipping")
+            self.set_status(PROVISION_STATUS_VERIFIED, wpa.version)
+            return
+
+        for key, param in bundle['config'].items():
+            if key in wpa.params:
+                wpa.params[key] = param
+        wpa.commit()
+        self.set_status(PROVISION_STATUS_CONFIGURED, wpa.version)
+        if self.timer is None:
+            self.timer = GLib.timeout_add_seconds(1, self.verify)
+        self.pending = (digest, wpa.version, bundle['config'].get('ssid', ''), time.time() + PROVISION_VERIFY_TIMEOUT)
+        self.dhcpcd_monitor.restart()
+
+    # Polled from the main loop until the WLAN joins the bundle's network.
+    # The SSID is probed asynchronously so GATT calls are served meanwhile.
+    def verify(self):
+        if self.pending is None:
+            self.timer = None
+            return False
+        digest, config, ssid, deadline = self.pending
+        if time.time() > deadline:
+            logger.error("Provisioning bundle failed verification")
+            self.set_status(PROVISION_STATUS_FAILED, config)
+            self.pending = None
+            self.timer = None
+            return False
+        if not self.probing and self.dhcpcd_monitor.state() == 'IDLE':
+            self.probe_ssid()
+        return True
+
+    def probe_ssid(self):
+        try:
+            pid, _, stdout, _ = GLib.spawn_async(
+                WLAN_SSID_CMD,
+                flags=GLib.SpawnFlags.SEARCH_PATH | GLib.SpawnFlags.DO_NOT_REAP_CHILD,
+                standard_output=True,
+            )
+        except GLib.Error as e:
+            logger.error(f"SSID probe failed: {e}")
+            return
+        self.probing = True
+        GLib.child_watch_add(GLib.PRIORITY_DEFAULT, pid, self.ssid_probed, stdout)
+
+    def ssid_probed(self, pid, status, stdout):
+        self.probing = False
+        with os.fdopen(stdout, 'r') as output:
+            ssid = output.read().strip()
+        GLib.spawn_close_pid(pid)
+        if self.pending is not None and ssid == self.pending[2]:
+            digest, config = self.pending[:2]
+            self.cache['verified'][digest] = config
+            self.set_status(PROVISION_STATUS_VERIFIED, config)
+            self.pending = None
+
+
+# Per-device state: staged configuration and whether it has been committed
+class Session():
+    def __init__(self, device):
+        self.device = device
+        self.wpa = WpaSupplicant()
+        self.committed = False
+        self.bundle = bytearray() # provisioning bundle assembled from long writes
+
+
+# Tracks a session for each connected central, keyed by BlueZ device path
+class SessionManager():
+    def __init__(self):
+        self.__sessions = {}
+        # Keys are indexed by server public key and outlive connections, since
+        # unbonded phones reconnect from a new address (and device path).
+        # Devices are bound to a key by a handshake or a resume.
+        self.__keys = {}
+        self.__devices = {}
+
+    def get(self, options):
+        device = str(options.get('device', ''))
+        if device not in self.__sessions:
+            logger.info("Opening session for " + device)
+            self.__sessions[device] = Session(device)
+        return self.__sessions[device]
+
+    def find(self, options):
+        return self.__sessions.get(str(options.get('device', '')))
+
+    def remove(self, device):
+        self.__devices.pop(str(device), None)
+        if self.__sessions.pop(str(device), None) is not None:
+            logger.info("Closed session for " + str(device))
+
+    def purge(self):
+        for public, key in list(self.__keys.items()):
+            if key.expired():
+                logger.info("Session key expired")
+                del self.__keys[public]
+        for device, public in list(self.__devices.items()):
+            if public not in self.__keys:
+                del self.__devices[device]
+
+    def handshake(self, options, peer_public):
+        self.purge()
+        device = str(options.get('device', ''))
+        logger.info("Deriving session key for " + device)
+        key = SessionKey(peer_public)
+        self.__keys[key.public] = key
+        self.__devices[device] = key.public
+        return key
+
+    # Binds a key from an earlier connection to this device, provided the
+    # client proves it holds the key
+    def resume(self, options, public, proof, aad):
+        self.purge()
+        device = str(options.get('device', ''))
+        key = self.__keys.get(public)
+        if key is None:
+            raise NotPermittedException('Unknown or expired session')
+        key.decrypt(proof, aad)
+        logger.info("Resumed session key for " + device)
+        self.__devices[device] = public
+        return key
+
+    def key(self, options):
+        device = str(options.get('device', ''))
+        key = self.__keys.get(self.__devices.get(device))
+        if key is not None and key.expired():
+            self.purge()
+            key = None
+        return key
+
+    def secure_key(self, options):
+        key = self.key(options)
+        if key is None and WLAN_REQUIRE_SECURE_SESSION:
+            raise NotPermittedException('Secure session required')
+        return key
+
+
+WLANMANAGE_SVC_UUID = "12634d89-d598-4874-8e86-7d042ee07ba7"
+WLAN_CONFIGURE_CHRC_UUID = "4116f8d2-9f66-4f58-a53d-fc7440e7c14e"
+WLAN_RESTART_CHRC_UUID = "9c7dbce8-de5f-4168-89dd-74f04f4e5842"
+WLAN_MAC_ADDR_CHRC_UUID = "16637984-be04-49b8-be43-86cf4efda929"
+WLAN_SECURE_SESSION_CHRC_UUID = "fdc207f4-22c1-4a65-b157-934e3dd39573"
+WLAN_PROVISION_CHRC_UUID = "e0f7a1b3-6c2d-4f8e-9a5b-3d1c7e2f4a60"
 
 
 class WlanManageS1Service(Service):
@@ -543,65 +987,64 @@ class WlanManageS1Service(Service):
     Service to manage configuration of the local WLAN adapter.
     Allows a user to configure and restart the WLAN wpa_applicant service
     """
+    __slots__ = ('sessions', 'dhcpcd_monitor', 'provisioner')
 
-    WLANMANAGE_SVC_UUID = "12634d89-d598-4874-8e86-7d042ee07ba7"
+    def __init__(self, index, uuid, primary):
+        Service.__init__(self, index, uuid, primary)
+        self.sessions = SessionManager()
+        self.dhcpcd_monitor = DhcpMonitor()
+        self.provisioner = FleetProvisioner(self.dhcpcd_monitor)
 
-    def __init__(self, bus, index):
-        Service.__init__(self, bus, index, self.WLANMANAGE_SVC_UUID, True)
-        self.add_characteristic(WlanConfigureCharacteristic(bus, 0, self))
-        self.add_characteristic(WlanRestartCharacteristic(bus, 1, self))
-        self.add_characteristic(WlanMacAddrCharacteristic(bus, 2, self))
+    def device_disconnected(self, device):
+        self.sessions.remove(device)
 
 
 class WlanConfigureCharacteristic(Characteristic):
-    uuid = "4116f8d2-9f66-4f58-a53d-fc7440e7c14e"
-    description = b"Configure WLAN interface {read:cur_config, write:new_config}"
-
-    def __init__(self, bus, index, service):
-        Characteristic.__init__(
-            self, bus, index, self.uuid, ["read", "write"], service,
-        )
-        self.add_descriptor(CharacteristicUserDescriptionDescriptor(bus, 1, self))
-        self.wpa = WpaSupplicant()
+    __slots__ = ()
 
     def ReadValue(self, options):
         logger.info('Reading current WLAN configuration')
-        # Load current wpa_supplicant values
-        self.wpa.read()
+        session = self.service.sessions.get(options)
+        # Load current wpa_supplicant values, discarding anything staged
+        session.wpa.read()
         # Response is JSON-encoded dict as a string of bytes
-        data = bytearray(json.dumps(self.wpa.params), 'utf-8')
-        logger.info(data)
+        data = bytearray(json.dumps(session.wpa.params), 'utf-8')
+        session_key = self.service.sessions.secure_key(options)
+        if session_key is not None:
+            data = bytearray(session_key.encrypt(data, self.uuid.encode()))
         return data
 
     def WriteValue(self, value, options):
         try:
             logger.info('Writing new WLAN configuration')
-            # Load current wpa_supplicant values
-            self.wpa.read()
+            session = self.service.sessions.get(options)
+            # Base the change on current values if this device never read them
+            if session.wpa.version is None:
+                session.wpa.read()
             # Value is JSON-encoded dict as a string of bytes
-            data = json.loads(bytearray(value).decode('utf-8')) # value is a dbus.Array
-            logger.info(data)
-            self.wpa.params = data
-            self.wpa.write()
+            value = bytearray(value) # value is a dbus.Array
+            session_key = self.service.sessions.secure_key(options)
+            if session_key is not None:
+                value = session_key.decrypt(value, self.uuid.encode())
+            data = json.loads(value.decode('utf-8'))
+            logger.info({k: v for k, v in data.items() if k != 'psk'})
+            # Stage known parameters, then commit if nobody else has written
+            for key, param in data.items():
+                if key in session.wpa.params:
+                    session.wpa.params[key] = param
+            session.wpa.commit()
+            session.committed = True
+            self.service.provisioner.set_status(PROVISION_STATUS_CONFIGURED, session.wpa.version)
         except Exception as e:
             logger.error(f"EXCEPTION: {e}")
             raise
 
-
 class WlanRestartCharacteristic(Characteristic):
-    uuid = "9c7dbce8-de5f-4168-89dd-74f04f4e5842"
-    description = b"Restart the WLAN interface {read:state, write:state}"
-
-    def __init__(self, bus, index, service):
-        Characteristic.__init__(
-            self, bus, index, self.uuid, ["read", "write"], service,
-        )
-        self.add_descriptor(CharacteristicUserDescriptionDescriptor(bus, 1, self))
-        self.dhcpcd_monitor = DhcpMonitor()
+    __slots__ = ()
 
     def ReadValue(self, options):
         logger.info('Reading restart state')
-        data = bytearray(self.dhcpcd_monitor.state(), 'utf-8')
+        data = bytearray(self.service.dhcpcd_monitor.state(), 'utf-8')
         logger.info(data)
         return data
 
@@ -610,12 +1053,16 @@ class WlanRestartCharacteristic(Characteristic):
             logger.info("Writing restart state")
             data = bytearray(value).decode('utf-8') # value is a dbus.Array
             logger.info(data)
+            # Only a device that configured the interface may restart it
+            session = self.service.sessions.find(options)
+            if session is None or not session.committed:
+                raise NotPermittedException()
             # Have to be idle to do anything else
-            if self.dhcpcd_monitor.state() == 'IDLE':
+            if self.service.dhcpcd_monitor.state() == 'IDLE':
                 # Now check to see if command is restart
                 if data == 'RESTART':
                     # Restart the wpa_supplicant service
-                    self.dhcpcd_monitor.restart()
+                    self.service.dhcpcd_monitor.restart()
                 else:
                     # Don't know this command, ignore
                     logger.info("Unknown restart state")
@@ -628,15 +1075,11 @@ class WlanRestartCharacteristic(Characteristic):
 
 
 class WlanMacAddrCharacteristic(Characteristic):
-    uuid = "16637984-be04-49b8-be43-86cf4efda929"
-    description = b"Retrieve the wireless interface MAC address {read:addr}"
+    __slots__ = ('value',)
 
-    def __init__(self, bus, index, service):
-        Characteristic.__init__(
-            self, bus, index, self.uuid, ["read"], service,
-        )
-        self.value = get_if_hwaddr(DEFAULT_WLAN_IFACE)
-        self.add_descriptor(CharacteristicUserDescriptionDescriptor(bus, 1, self))
+    def __init__(self, index, uuid, flags, service, description=None):
+        Characteristic.__init__(self, index, uuid, flags, service, description)
+        self.value = wlan_hwaddr()
 
     def ReadValue(self, options):
         logger.info('Reading WLAN interface MAC address')
@@ -645,15 +1088,271 @@ class WlanMacAddrCharacteristic(Characteristic):
         return data
 
 
+class WlanSecureSessionCharacteristic(Characteristic):
+    __slots__ = ()
+
+    def ReadValue(self, options):
+        logger.info('Reading session public key')
+        # Empty until this device has handshaken or resumed
+        key = self.service.sessions.key(options)
+        if key is None:
+            return bytearray()
+        return bytearray(key.public)
+
+    # A client public key starts a handshake. A server public key plus proof
+    # resumes that key, so reconnects skip the handshake.
+    def WriteValue(self, value, options):
+        try:
+            logger.info('Writing session public key')
+            value = bytes(bytearray(value))
+            if len(value) == SESSION_PUBLIC_KEY_LEN:
+                self.service.sessions.handshake(options, value)
+            elif len(value) == SESSION_RESUME_LEN:
+                self.service.sessions.resume(
+                    options,
+                    value[:SESSION_PUBLIC_KEY_LEN],
+                    value[SESSION_PUBLIC_KEY_LEN:],
+                    self.uuid.encode(),
+                )
+            else:
+                raise InvalidValueLengthException()
+        except Exception as e:
+            logger.error(f"EXCEPTION: {e}")
+            raise
+
+
+class WlanProvisionCharacteristic(Characteristic):
+    __slots__ = ()
+
+    def ReadValue(self, options):
+        logger.info('Reading provisioning status')
+        provisioner = self.service.provisioner
+        data = bytearray(json.dumps({
+            'id': bytes(provisioner.device_id).hex(),
+            'status': PROVISION_STATUS_NAMES[provisioner.status],
+        }), 'utf-8')
+        logger.info(data)
+        return data
+
+    def WriteValue(self, value, options):
+        try:
+            logger.info('Writing provisioning bundle')
+            provisioner = self.service.provisioner
+            if provisioner.public_key is None:
+                raise NotSupportedException('No fleet key installed')
+            # Bundles exceed the ATT MTU, so collect long writes by offset
+            # until the length header is satisfied
+            session = self.service.sessions.get(options)
+            offset = int(options.get('offset', 0))
+            if offset == 0:
+                session.bundle = bytearray()
+            # A gap means a chunk was lost or reordered
+            if offset > len(session.bundle):
+                session.bundle = bytearray()
+                raise InvalidOffsetException()
+            if offset + len(value) > GATT_MAX_ATTR_LEN:
+                session.bundle = bytearray()
+                raise InvalidValueLengthException()
+            session.bundle[offset:] = bytearray(value)
+            if len(session.bundle) < PROVISION_HEADER_LEN:
+                return
+            length = int.from_bytes(session.bundle[:PROVISION_HEADER_LEN], 'big')
+            if PROVISION_HEADER_LEN + length > GATT_MAX_ATTR_LEN:
+                session.bundle = bytearray()
+                raise InvalidValueLengthException()
+            if len(session.bundle) < PROVISION_HEADER_LEN + length:
+                return
+            frame = bytes(session.bundle[PROVISION_HEADER_LEN:PROVISION_HEADER_LEN + length])
+            session.bundle = bytearray()
+            session_key = self.service.sessions.secure_key(options)
+            if session_key is not None:
+                frame = session_key.decrypt(frame, self.uuid.encode())
+            provisioner.provision(frame)
+        except Exception as e:
+            logger.error(f"EXCEPTION: {e}")
+            raise
+
+
+# Every service is declared here: (handler, index, UUID, primary, characteristics),
+# each characteristic as (handler, UUID, flags, description). Characteristics
+# with a description get a CUD descriptor carrying it.
+GATT_SCHEMA = (
+    (WlanManageS1Service, 2, WLANMANAGE_SVC_UUID, True, (
+        (WlanConfigureCharacteristic, WLAN_CONFIGURE_CHRC_UUID, ("read", "write"),
+            "Configure WLAN interface {read:cur_config, write:new_config}"),
+        (WlanRestartCharacteristic, WLAN_RESTART_CHRC_UUID, ("read", "write"),
+            "Restart the WLAN interface {read:state, write:state}"),
+        (WlanMacAddrCharacteristic, WLAN_MAC_ADDR_CHRC_UUID, ("read",),
+            "Retrieve the wireless interface MAC address {read:addr}"),
+        (WlanSecureSessionCharacteristic, WLAN_SECURE_SESSION_CHRC_UUID, ("read", "write"),
+            "Establish an encrypted session {read:server_key, write:client_key}"),
+        (WlanProvisionCharacteristic, WLAN_PROVISION_CHRC_UUID, ("read", "write"),
+            "Apply a signed provisioning bundle {read:status, write:bundle}"),
+    )),
+)
+
+
+# Legacy advertising data is limited to 31 bytes:
+#   flags                                   3
+#   128-bit service UUID (1 + 1 + 16)      18
+#   manufacturer data (1 + 1 + 2 + 6)      10
+# The tx-power include (3 more) no longer fits and is left out.
 class WlanSetupAdvertisement(Advertisement):
-    def __init__(self, bus, index):
+    def __init__(self, bus, index, provisioner):
         Advertisement.__init__(self, bus, index, "peripheral")
+        self.provisioner = provisioner
+        self.update_manufacturer_data()
+        self.add_service_uuid(WLANMANAGE_SVC_UUID)
+        self.add_local_name(WLAN_IFACE_BT_NAME)
+
+    # 0x70 0x74, status, last three MAC bytes: lets a scanner pick out
+    # unprovisioned units without connecting
+    def update_manufacturer_data(self):
         self.add_manufacturer_data(
-            0xFFFF, [0x70, 0x74],
+            0xFFFF, [0x70, 0x74, self.provisioner.status] + self.provisioner.device_id,
+        )
+
+    # BlueZ watches a registered advertisement's properties and refreshes the
+    # advertising data on change, so no re-registration is needed
+    def refresh(self):
+        self.update_manufacturer_data()
+        self.PropertiesChanged(
+            LE_ADVERTISEMENT_IFACE,
+            {'ManufacturerData': self.get_properties()[LE_ADVERTISEMENT_IFACE]['ManufacturerData']},
+            [],
         )
-        self.add_service_uuid(WlanManageS1Service.WLANMANAGE_SVC_UUID)
-        self.add_local_name(WLAN_IFACE_BT_NAME)
-        self.include_tx_power = True
+
+
+# Opt-in GATT trace: set WPABLE_TRACE to the file that records are appended to
+WPABLE_TRACE_PATH = os.environ.get('WPABLE_TRACE')
+TRACE_METHODS = ('GetManagedObjects', 'GetAll', 'ReadValue', 'WriteValue', 'StartNotify', 'StopNotify')
+TRACE_REDACT_KEYS = ('psk',)
+TRACE_REDACTED = '********'
+TRACE_PLAIN_PAYLOADS = ('RESTART',)
+
+def redact_json(data):
+    if isinstance(data, dict):
+        return {k: TRACE_REDACTED if k in TRACE_REDACT_KEYS else redact_json(v) for k, v in data.items()}
+    if isinstance(data, list):
+        return [redact_json(v) for v in data]
+    return data
+
+# Payloads are kept for replay only if they are known commands or complete
+# JSON objects/arrays, with secrets masked at any depth. Everything else
+# (keys, ciphertext, long-write chunks) is recorded by size only.
+def redact(value):
+    try:
+        text = bytes(value).decode('utf-8')
+    except UnicodeDecodeError:
+        return None
+    if text in TRACE_PLAIN_PAYLOADS:
+        return text
+    try:
+        data = json.loads(text)
+    except ValueError:
+        return None
+    if not isinstance(data, (dict, list)):
+        return None
+    return json.dumps(redact_json(data))
+
+
+# Appends one JSON line per GATT method call made on the application tree
+class TraceRecorder():
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.file = open(file_path, 'a', buffering=1)
+
+    def install(self, app, bus):
+        # Application forwards GATT calls to the objects it serves, so trace
+        # those and only its own GetManagedObjects. Slotted instances cannot
+        # be patched, so wrap the functions in their class dicts.
+        self.wrap_class(type(app), ('GetManagedObjects',))
+        for obj in app.objects.values():
+            for cls in type(obj).__mro__:
+                self.wrap_class(cls, TRACE_METHODS)
+        bus.add_signal_receiver(
+            self.properties_changed,
+            dbus_interface=DBUS_PROP_IFACE,
+            signal_name='PropertiesChanged',
+            bus_name=BLUEZ_SERVICE_NAME,
+            arg0=BLUEZ_DEVICE_IFACE,
+            path_keyword='path',
+        )
+        logger.info("Tracing GATT calls to " + self.file_path)
+
+    def wrap_class(self, cls, names):
+        for name in names:
+            func = cls.__dict__.get(name)
+            if func is not None and not hasattr(func, '_wpable_traced'):
+                setattr(cls, name, self.wrap(func))
+
+    def wrap(self, func):
+        recorder = self
+
+        @functools.wraps(func)
+        def traced(obj, *args, **kwargs):
+            start = time.time()
+            result = None
+            error = None
+            try:
+                result = func(obj, *args, **kwargs)
+                return result
+            except Exception as e:
+                error = type(e).__name__
+                raise
+            finally:
+                recorder.record(obj, func.__name__, args, result, start, error)
+        traced._wpable_traced = True
+        return traced
+
+    def record(self, obj, op, args, result, start, error):
+        entry = {
+            't': round(start, 6),
+            'dur': round(time.time() - start, 6),
+            'op': op,
+            'path': obj.path,
+        }
+        options = args[-1] if args and isinstance(args[-1], dict) else {}
+        if 'device' in options:
+            entry['device'] = str(options['device'])
+        extra = {str(k): v for k, v in options.items() if k != 'device'}
+        if extra:
+            entry['options'] = extra
+        if op == 'WriteValue':
+            entry['in'] = len(args[0])
+            payload = redact(args[0])
+            if payload is not None:
+                entry['payload'] = payload
+        elif op == 'GetAll':
+            entry['iface'] = str(args[0])
+        if op == 'ReadValue' and result is not None:
+            entry['out'] = len(result)
+        if error is not None:
+            entry['err'] = error
+        self.write(entry)
+
+    def properties_changed(self, interface, changed, invalidated, path=None):
+        if 'Connected' in changed and not changed['Connected']:
+            self.write({'t': round(time.time(), 6), 'op': 'Disconnect', 'device': str(path)})
+
+    def write(self, entry):
+        try:
+            self.file.write(json.dumps(entry, separators=(',', ':')) + '\n')
+        except Exception as e:
+            logger.error(f"Trace write failed: {e}")
+
+
+def create_application(bus, schema=GATT_SCHEMA):
+    app = Application(bus)
+    for service_cls, index, uuid, primary, chrcs in schema:
+        service = service_cls(index, uuid, primary)
+        for chrc_index, (chrc_cls, chrc_uuid, flags, description) in enumerate(chrcs):
+            chrc = chrc_cls(chrc_index, chrc_uuid, flags, service, description)
+            if description is not None:
+                chrc.add_descriptor(CharacteristicUserDescriptionDescriptor(1, chrc))
+            service.add_characteristic(chrc)
+        app.add_service(service)
+    return app
 
 
 def register_app_cb():
@@ -705,6 +1404,8 @@ def set_trusted(path):
 def main():
     global mainloop
 
+    setup_logging()
+
     dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
 
     bus = dbus.SystemBus()
@@ -725,13 +1426,18 @@ def main():
     service_manager = dbus.Interface(adapter_obj, GATT_MANAGER_IFACE)
     ad_manager = dbus.Interface(adapter_obj, LE_ADVERTISING_MANAGER_IFACE)
 
-    advertisement = WlanSetupAdvertisement(bus, 0)
     bluez_obj = bus.get_object(BLUEZ_SERVICE_NAME, "/org/bluez")
 
     agent = Agent(bus, AGENT_PATH)
 
-    app = Application(bus)
-    app.add_service(WlanManageS1Service(bus, 2))
+    app = create_application(bus)
+    if WPABLE_TRACE_PATH:
+        TraceRecorder(WPABLE_TRACE_PATH).install(app, bus)
+
+    # Advertise the provisioning status and refresh it whenever it changes
+    provisioner = app.services[0].provisioner
+    advertisement = WlanSetupAdvertisement(bus, 0, provisioner)
+    provisioner.listeners.append(lambda status: advertisement.refresh())
 
     agent_manager = dbus.Interface(bluez_obj, "org.bluez.AgentManager1")
     agent_manager.RegisterAgent(AGENT_PATH, "NoInputNoOutput")